@@ -0,0 +1,182 @@
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+NUM_OF_WHITE_KEYS = 52
+# Pixels brighter than this are considered part of a white key
+WHITE_THRESHOLD = 200
+# Fraction of bright pixels a row must have to belong to the keyboard
+ROW_FILL_RATIO = 0.45
+# Fraction of bright pixels a column must have to belong to the keyboard
+COLUMN_FILL_RATIO = 0.5
+# Part of the keyboard height (from the top) that is sampled for white key gaps, below the black keys
+GAP_SAMPLE_BAND = (0.75, 0.85)
+# Beside driver/device.ini in the working directory, the module folder is a temporary extraction folder in the one-file build
+CACHE_FILE = os.path.join('driver', 'calibration_cache.json')
+
+
+class KeyboardGeometry(object):
+
+    def __init__(self, left_upper, right_lower, white_key_edges=None):
+        super(KeyboardGeometry, self).__init__()
+        self.left_upper = (int(left_upper[0]), int(left_upper[1]))
+        self.right_lower = (int(right_lower[0]), int(right_lower[1]))
+        self.width = self.right_lower[0] - self.left_upper[0]
+        self.height = self.right_lower[1] - self.left_upper[1]
+        if white_key_edges is None:
+            white_key_edges = uniform_white_key_edges(self.width)
+        # Relative x of every white key boundary, NUM_OF_WHITE_KEYS + 1 values from 0 to width
+        self.white_key_edges = [float(x) for x in white_key_edges]
+
+    def to_dict(self):
+        return {"left_upper": list(self.left_upper), "right_lower": list(self.right_lower), "white_key_edges": self.white_key_edges}
+
+    @staticmethod
+    def from_dict(d):
+        return KeyboardGeometry(d["left_upper"], d["right_lower"], d.get("white_key_edges"))
+
+    def __repr__(self):
+        return "KeyboardGeometry(%s, %s)" % (self.left_upper, self.right_lower)
+
+
+def uniform_white_key_edges(width):
+    return np.linspace(0, width, NUM_OF_WHITE_KEYS + 1).tolist()
+
+
+def load_image(path):
+    import cv2  # Only needed for offline calibration from a file
+
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError(f"Unable to read image '{path}'")
+    return img
+
+
+def to_gray(image):
+    image = np.asarray(image)
+    if image.ndim == 2:
+        return image.astype(np.float32)
+    # BGR, as returned by cv2 and airtest snapshots
+    return image[..., :3].astype(np.float32) @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+
+
+def longest_run(mask):
+    """
+    Start and end (exclusive) of the longest run of True in a 1-D boolean array, or None
+    """
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    changes = np.flatnonzero(np.diff(padded))
+    if len(changes) == 0:
+        return None
+    starts, ends = changes[0::2], changes[1::2]
+    longest = np.argmax(ends - starts)
+    return int(starts[longest]), int(ends[longest])
+
+
+def find_keyboard_box(gray):
+    bright = gray > WHITE_THRESHOLD
+    rows = longest_run(bright.mean(axis=1) > ROW_FILL_RATIO)
+    if rows is None:
+        raise ValueError("No keyboard found in image")
+    top, bottom = rows
+    columns = np.flatnonzero(bright[top:bottom].mean(axis=0) > COLUMN_FILL_RATIO)
+    if len(columns) == 0:
+        raise ValueError("No keyboard found in image")
+    return (int(columns[0]), top), (int(columns[-1]) + 1, bottom)
+
+
+def find_white_key_edges(gray, left_upper, right_lower):
+    left, top = left_upper
+    right, bottom = right_lower
+    height = bottom - top
+    band = gray[top + int(height * GAP_SAMPLE_BAND[0]):top + max(int(height * GAP_SAMPLE_BAND[1]), int(height * GAP_SAMPLE_BAND[0]) + 1), left:right]
+    profile = band.mean(axis=0)
+    # Gaps between white keys are the dark columns of the intensity profile
+    dark = profile < (np.median(profile) + profile.min()) / 2
+    padded = np.concatenate(([False], dark, [False])).astype(np.int8)
+    changes = np.flatnonzero(np.diff(padded))
+    centers = (changes[0::2] + changes[1::2] - 1) / 2
+    # Drop gaps touching the border of the keyboard
+    centers = centers[(centers > 0) & (centers < right - left - 1)]
+    if len(centers) != NUM_OF_WHITE_KEYS - 1:
+        return None
+    return [0.0] + centers.tolist() + [float(right - left)]
+
+
+def calibrate(image) -> KeyboardGeometry:
+    gray = to_gray(image)
+    left_upper, right_lower = find_keyboard_box(gray)
+    return KeyboardGeometry(left_upper, right_lower, find_white_key_edges(gray, left_upper, right_lower))
+
+
+class CalibrationCache(object):
+
+    def __init__(self, cache_file=CACHE_FILE):
+        super(CalibrationCache, self).__init__()
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = None
+
+    @staticmethod
+    def resolution_key(resolution):
+        return "%dx%d" % (resolution[0], resolution[1])
+
+    def load(self):
+        if self.entries is None:
+            self.entries = {}
+            if os.path.exists(self.cache_file):
+                try:
+                    with open(self.cache_file, 'r') as f:
+                        self.entries = json.load(f)
+                except (OSError, ValueError) as e:
+                    print("Ignoring invalid calibration cache", e)
+        return self.entries
+
+    def save(self):
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+        except OSError as e:
+            # Calibration stays cached in memory for this run
+            print("Unable to save calibration cache", e)
+
+    def get(self, resolution):
+        with self.lock:
+            entry = self.load().get(self.resolution_key(resolution))
+        return KeyboardGeometry.from_dict(entry) if entry is not None else None
+
+    def put(self, resolution, geometry: KeyboardGeometry):
+        with self.lock:
+            self.load()[self.resolution_key(resolution)] = geometry.to_dict()
+            self.save()
+
+    def get_or_calibrate(self, resolution, image_source) -> KeyboardGeometry:
+        """
+        Return the cached geometry for a resolution, calibrating only on a cache miss
+
+        :param image_source: callable returning a screenshot, only called on a cache miss
+        """
+        geometry = self.get(resolution)
+        if geometry is None:
+            print("No calibration for resolution %s, calibrating..." % self.resolution_key(resolution))
+            geometry = calibrate(image_source())
+            self.put(resolution, geometry)
+            print("Calibrated keyboard at", geometry)
+        return geometry
+
+
+calibration_cache = CalibrationCache()
+
+
+if __name__ == '__main__':
+    # Calibrate from a screenshot file, e.g. python -m cv.calibration img_sample/screenshot.jpg
+    img = load_image(sys.argv[1])
+    geo = calibrate(img)
+    print(geo)
+    print("White key edges", "detected" if geo.white_key_edges != uniform_white_key_edges(geo.width) else "uniform")
+    if len(sys.argv) > 2 and sys.argv[2] == '--save':
+        calibration_cache.put((img.shape[1], img.shape[0]), geo)
+        print("Saved to", calibration_cache.cache_file)
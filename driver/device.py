@@ -1,8 +1,13 @@
 import configparser
+import time
 
 from airtest.core.android.touch_methods.base_touch import *
 from airtest.core.api import *
 
+from cv.calibration import KeyboardGeometry, calibration_cache
+from driver.ring_buffer import RingBuffer
+from profiling import COUNTERS
+
 
 def Const(cls):
     @wraps(cls)
@@ -54,11 +59,19 @@ class _Const(object):
 
 CONST = _Const()
 
+# Presses buffered between two timer callbacks, far more than a sampling interval can hold
+PRESS_QUEUE_CAPACITY = 1024
+
 
 class DeviceSession(object):
 
-    def __init__(self, ip=None):
+    def __init__(self, ip=None, geometry: KeyboardGeometry = None, start_timer=True, verbose=True):
+        """
+        :param start_timer: start sending batches every SAMPLING_INTERVAL, disabled when batches are collected by the caller
+        :param verbose: print every note played
+        """
         super(DeviceSession, self).__init__()
+        self.verbose = verbose
         self.ori_transformer = None
         self.timer = None
         self.ip = ip
@@ -67,23 +80,33 @@ class DeviceSession(object):
         if ip is not None:
             self.connect(ip)
 
-        self.down_event_to_perform = []
+        # Notes pushed by the single DeviceWorker of this device and drained by the timer, lock-free
+        self.down_event_to_perform = RingBuffer(PRESS_QUEUE_CAPACITY)
+        # Only touched by the timer
         self.down_event_to_revoke = []
 
         # Touch position on 88-key piano given a note
-        self.piano_width = CONST.PianoCropBox.RIGHT_LOWER[0] - CONST.PianoCropBox.LEFT_UPPER[0]
-        self.piano_height = CONST.PianoCropBox.RIGHT_LOWER[1] - CONST.PianoCropBox.LEFT_UPPER[1]
-
+        if geometry is None and self.is_connected():
+            try:
+                geometry = calibration_cache.get_or_calibrate(self.get_resolution(), self.device.snapshot)
+            except ValueError as e:
+                # Piano screen not showing, nothing is cached so the next connection calibrates again
+                print("Calibration failed, using the default keyboard region:", e)
+        if geometry is None:
+            geometry = KeyboardGeometry(CONST.PianoCropBox.LEFT_UPPER, CONST.PianoCropBox.RIGHT_LOWER)
+        self.geometry = geometry
+        self.piano_width = geometry.width
+        self.piano_height = geometry.height
+        self.white_key_edges = geometry.white_key_edges
+
+        # Index of the first white key of each octave group, the last entry closes the final group
+        self.octave_first_white_key = [0, 2] + [2 + 7 * (i + 1) for i in range(CONST.PianoSetting.NUM_OF_OCTAVES)] + [len(self.white_key_edges) - 1]
         self.octaves_start_end_pixel = []
-        self.unit_white_key = self.piano_width / 52
-        self.octaves_start_end_pixel.append((0, 0 + 2 * self.unit_white_key))
-        full_octave_width = 7 * self.unit_white_key
-        start_of_first_full_octave = self.octaves_start_end_pixel[0][1]
-        for i in range(0, CONST.PianoSetting.NUM_OF_OCTAVES):
-            self.octaves_start_end_pixel.append((start_of_first_full_octave + full_octave_width * i, start_of_first_full_octave + full_octave_width * (i + 1)))
-        self.octaves_start_end_pixel.append((self.octaves_start_end_pixel[-1][1], self.piano_width))
+        for i in range(len(self.octave_first_white_key) - 1):
+            self.octaves_start_end_pixel.append((self.white_key_edges[self.octave_first_white_key[i]], self.white_key_edges[self.octave_first_white_key[i + 1]]))
 
-        self.set_timer()
+        if start_timer:
+            self.set_timer()
 
     def connect(self, ip):
         self.ip = ip
@@ -96,6 +119,7 @@ class DeviceSession(object):
         # call timer_callback every 0.1 second
         self.timer = threading.Timer(CONST.PianoSetting.SAMPLING_INTERVAL, self.timer_callback)
         self.timer.start()
+        COUNTERS.add("timers_created")
 
     def generate_id_incremental(self):
         self.id_gen = (self.id_gen + 1) % 10
@@ -114,35 +138,65 @@ class DeviceSession(object):
         """
         return self.device.get_current_resolution()
 
+    def measure_latency(self, samples=5) -> float:
+        """
+        Estimate the one way latency to the device as half of the median adb round trip
+
+        :rtype: seconds
+        """
+        if not self.is_connected():
+            return 0.0
+        round_trips = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            self.device.shell("echo")
+            round_trips.append(time.perf_counter() - start)
+        round_trips.sort()
+        return round_trips[len(round_trips) // 2] / 2
+
     def play_note(self, note):
+        # Reject keys outside of the piano here, on the caller's thread, rather than in the timer
+        self.get_note_group_and_relative(note)
         # Print key to press and name of note
-        print(f"Playing key id {note}, note {self.get_note_by_key_index(note)}")
+        if self.verbose:
+            print(f"Playing key id {note}, note {self.get_note_by_key_index(note)}")
         # x, y = self.translate_note_to_real_coordinate(note)
         # touch((x, y), duration=0.1)
-        self.down_event_to_perform.append(note)
+        if not self.down_event_to_perform.push(note):
+            COUNTERS.add("presses_dropped")
 
     def release_note(self, note: list):
         # print("Releasing note %d" % note)
         pass
 
-    def timer_callback(self):
+    def collect_touch_events(self) -> list:
+        """
+        Drain the pending notes into one multi touch batch, lifting the fingers of the previous batch first
+        """
         multi_touch_event = []
         if len(self.down_event_to_revoke) > 0:
             for op_id in self.down_event_to_revoke:
                 multi_touch_event.append(UpEvent(op_id))
             self.down_event_to_revoke = []
-        if len(self.down_event_to_perform) > 0:
-            for n in self.down_event_to_perform:
-                op_id = self.generate_id_incremental()
-                multi_touch_event.append(DownEvent(self.ori_transformer(self.translate_note_to_real_coordinate(n)), op_id, 40))
-                self.down_event_to_revoke.append(op_id)
-            self.down_event_to_perform = []
+        for n in self.down_event_to_perform.drain():
+            op_id = self.generate_id_incremental()
+            multi_touch_event.append(DownEvent(self.transform(self.translate_note_to_real_coordinate(n)), op_id, 40))
+            self.down_event_to_revoke.append(op_id)
+        return multi_touch_event
+
+    def timer_callback(self):
+        multi_touch_event = self.collect_touch_events()
         if len(multi_touch_event) > 0:
-            device().touch_proxy.perform(multi_touch_event)
+            self.device.touch_proxy.perform(multi_touch_event)
+            COUNTERS.add("batches_sent")
+            COUNTERS.record_max("max_batch_size", len(multi_touch_event))
         self.set_timer()
 
     @staticmethod
     def get_note_group_and_relative(note) -> (int, int):
+        if not 0 <= note <= 87:
+            # Keys are mapped into range by midi.pitch_map before playback
+            raise ValueError("Key %d is outside of the piano" % note)
         if note < 3:
             return 0, note
         elif note < 87:
@@ -159,7 +213,8 @@ class DeviceSession(object):
         group, relative = self.get_note_group_and_relative(note)
         if relative in CONST.PianoSetting.WHITE_KEY_INDEX:
             # White key
-            x = self.octaves_start_end_pixel[group][0] + self.unit_white_key * (CONST.PianoSetting.WHITE_KEY_INDEX.index(relative) + 0.5)
+            white_key = self.octave_first_white_key[group] + CONST.PianoSetting.WHITE_KEY_INDEX.index(relative)
+            x = (self.white_key_edges[white_key] + self.white_key_edges[white_key + 1]) / 2
             y = self.piano_height * CONST.WhiteKeyRelativeRatio.VERTICAL
         else:
             # Black key
@@ -167,9 +222,13 @@ class DeviceSession(object):
             y = self.piano_height * CONST.BlackKeyRelativeRatio.VERTICAL
         return x, y
 
+    def transform(self, coordinate) -> (float, float):
+        # Screen orientation of the device, identity without one
+        return self.ori_transformer(coordinate) if self.ori_transformer is not None else coordinate
+
     def translate_note_to_real_coordinate(self, note) -> (float, float):
         relative_x, relative_y = self.get_note_position(note)
-        return relative_x + CONST.PianoCropBox.LEFT_UPPER[0], relative_y + CONST.PianoCropBox.LEFT_UPPER[1]
+        return relative_x + self.geometry.left_upper[0], relative_y + self.geometry.left_upper[1]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,312 @@
+import bisect
+import threading
+import time
+
+
+class SharedClock(object):
+    """
+    Master song clock shared by every device, song time follows the wall clock while running
+    """
+
+    def __init__(self, time_source=time.perf_counter):
+        """
+        :param time_source: wall clock in seconds, time.perf_counter unless rendering offline
+        """
+        super(SharedClock, self).__init__()
+        self.time_source = time_source
+        # Notified on every change of state, the underlying lock is reentrant
+        self.changed = threading.Condition()
+        self.running = False
+        self.speed = 1.0
+        # Incremented on every jump in song time so that workers know to look up their position again
+        self.generation = 0
+        self.seek_time = 0.0
+        self.base_song_time = 0.0
+        self.base_wall_time = time_source()
+
+    def now(self) -> float:
+        if not self.running:
+            return self.base_song_time
+        return self.base_song_time + (self.time_source() - self.base_wall_time) * self.speed
+
+    def rebase(self):
+        self.base_song_time = self.now()
+        self.base_wall_time = self.time_source()
+
+    def start(self):
+        with self.changed:
+            if not self.running:
+                self.base_wall_time = self.time_source()
+                self.running = True
+                self.changed.notify_all()
+
+    def pause(self):
+        with self.changed:
+            if self.running:
+                self.rebase()
+                self.running = False
+                self.changed.notify_all()
+
+    def seek(self, song_time):
+        with self.changed:
+            self.base_song_time = song_time
+            self.base_wall_time = self.time_source()
+            self.seek_time = song_time
+            self.generation += 1
+            self.changed.notify_all()
+
+    def set_speed(self, speed):
+        with self.changed:
+            self.rebase()
+            self.speed = speed
+            self.changed.notify_all()
+
+
+class VirtualClock(SharedClock):
+    """
+    SharedClock on a simulated wall clock for offline rendering, wall time only moves when advanced
+    """
+
+    def __init__(self, start=0.0):
+        self.wall_time = start
+        super(VirtualClock, self).__init__(lambda: self.wall_time)
+
+    def advance_to(self, wall_time):
+        with self.changed:
+            self.wall_time = max(self.wall_time, wall_time)
+
+
+class DeviceWorker(threading.Thread):
+    """
+    Send thread of a single device, walks the shared timeline and fires its events ahead by the device latency offset
+    """
+
+    def __init__(self, session, device, latency):
+        super(DeviceWorker, self).__init__(daemon=True)
+        self.session = session
+        self.device = device
+        self.latency = latency
+        self.latency_offset = 0.0
+        # (start song time, timeline) currently walked, may be ahead of the session by the latency offset
+        self.segment = None
+        self.generation = -1
+        self.index = 0
+
+    def next_event(self):
+        """
+        Move on to the next event due on the clock, the caller holds clock.changed
+
+        :return: (key, press) of an event to fire now or None, and the wall seconds until the next one, None to wait for a change
+        """
+        clock = self.session.clock
+        segments = self.session.segments
+        if not segments or not clock.running:
+            return None, None
+        if clock.generation != self.generation or self.segment not in segments:
+            # Jumped in song time, or fell behind a finished song
+            position = clock.seek_time if clock.generation != self.generation else clock.now()
+            self.generation = clock.generation
+            self.segment = segments[0]
+            self.index = bisect.bisect_left(self.segment[1].time_list, position - self.segment[0])
+        while True:
+            start, timeline = self.segment
+            if self.index < len(timeline.events):
+                break
+            following = self.session.segment_after(self.segment)
+            if following is None:
+                return None, None
+            self.segment = following
+            self.index = 0
+        event_time, key, press = timeline.events[self.index]
+        wait = (start + event_time - clock.now()) / clock.speed - self.latency_offset
+        if wait > 0:
+            return None, wait
+        self.index += 1
+        return (key, press), None
+
+    def fire(self, key, press):
+        try:
+            if press:
+                self.device.play_note(key)
+            else:
+                self.device.release_note(key)
+        except Exception as e:
+            # A bad note or a transport error must not stop this device for the rest of the session
+            print("Error playing key", key, e)
+
+    def run(self):
+        clock = self.session.clock
+        while True:
+            with clock.changed:
+                if self.session.closed:
+                    return
+                event, wait = self.next_event()
+                if event is None:
+                    clock.changed.wait(wait)
+                    continue
+            self.fire(*event)
+
+
+class FanoutSession(object):
+    """
+    Plays timelines on any number of devices against a single SharedClock, queued timelines follow without a gap
+    """
+
+    def __init__(self, on_finished=None, on_advanced=None, clock: SharedClock = None, start_threads=True):
+        """
+        :param on_finished: called without arguments when the last timeline ends
+        :param on_advanced: called with the timeline now playing after a queued timeline took over
+        :param clock: a VirtualClock when rendering offline
+        :param start_threads: start the device workers and the end watcher, disabled when the caller steps them on a VirtualClock
+        """
+        super(FanoutSession, self).__init__()
+        self.clock = clock if clock is not None else SharedClock()
+        # (start song time, timeline) of the current timeline followed by the queued ones
+        self.segments = []
+        self.on_finished = on_finished
+        self.on_advanced = on_advanced
+        self.workers = []
+        self.closed = False
+        self.start_threads = start_threads
+        self.end_watcher = threading.Thread(target=self.watch_end, daemon=True)
+        if start_threads:
+            self.end_watcher.start()
+
+    def add_device(self, device, latency=None):
+        """
+        :param latency: one way latency of the device in seconds, measured if not given
+        """
+        if latency is None:
+            latency = device.measure_latency() if hasattr(device, "measure_latency") else 0.0
+        worker = DeviceWorker(self, device, latency)
+        with self.clock.changed:
+            self.workers.append(worker)
+            # Fire every device early by how much slower it is than the fastest one
+            fastest = min(w.latency for w in self.workers)
+            for w in self.workers:
+                w.latency_offset = w.latency - fastest
+        print("Added device with latency %.1f ms" % (latency * 1000))
+        if self.start_threads:
+            worker.start()
+        return worker
+
+    @property
+    def timeline(self):
+        return self.segments[0][1] if self.segments else None
+
+    def load(self, timeline):
+        with self.clock.changed:
+            self.clock.pause()
+            self.segments = [(0.0, timeline)]
+            self.clock.seek(0.0)
+
+    def append(self, timeline):
+        """
+        Queue a timeline to start right when the previous one ends
+
+        :return: the (start song time, timeline) segment queued
+        """
+        with self.clock.changed:
+            if not self.segments:
+                self.load(timeline)
+                return self.segments[0]
+            start, last = self.segments[-1]
+            segment = (start + last.duration, timeline)
+            self.segments.append(segment)
+            self.clock.changed.notify_all()
+            return segment
+
+    def segment_after(self, segment):
+        segments = self.segments
+        for i in range(len(segments) - 1):
+            if segments[i] is segment:
+                return segments[i + 1]
+        return None
+
+    @property
+    def is_playing(self):
+        return self.clock.running
+
+    def play(self):
+        if self.timeline is not None:
+            self.clock.start()
+
+    def pause(self):
+        self.clock.pause()
+
+    def toggle(self):
+        if self.is_playing:
+            self.pause()
+        else:
+            self.play()
+        return self.is_playing
+
+    def seek(self, song_time):
+        """
+        Seek within the current timeline, seeking to its end moves on to the next one
+        """
+        with self.clock.changed:
+            if self.segments:
+                start, timeline = self.segments[0]
+                self.clock.seek(start + min(max(song_time, 0.0), timeline.duration))
+
+    def set_speed(self, speed):
+        self.clock.set_speed(speed)
+
+    def position(self) -> float:
+        """
+        Position in the current timeline
+        """
+        with self.clock.changed:
+            return self.clock.now() - self.segments[0][0] if self.segments else 0.0
+
+    def close(self):
+        with self.clock.changed:
+            self.closed = True
+            self.clock.changed.notify_all()
+
+    def remaining_time(self):
+        """
+        Wall seconds until the current timeline ends, None while there is nothing playing, the caller holds clock.changed
+        """
+        if not self.segments or not self.clock.running:
+            return None
+        start, timeline = self.segments[0]
+        return (start + timeline.duration - self.clock.now()) / self.clock.speed
+
+    def end_timeline(self):
+        """
+        Move on to the queued timeline once the current one has ended, or stop after the last one
+        """
+        with self.clock.changed:
+            remaining = self.remaining_time()
+            if remaining is None or remaining > 0:
+                # Loaded or seeked since the end was seen
+                return
+            start, timeline = self.segments[0]
+            if len(self.segments) > 1:
+                # The clock keeps running, workers have already moved on to the next timeline
+                self.segments = self.segments[1:]
+                self.clock.changed.notify_all()
+                advanced_to = self.segments[0][1]
+            else:
+                self.clock.pause()
+                self.clock.seek(start + timeline.duration)
+                advanced_to = None
+        if advanced_to is not None:
+            if self.on_advanced is not None:
+                self.on_advanced(advanced_to)
+        elif self.on_finished is not None:
+            self.on_finished()
+
+    def watch_end(self):
+        clock = self.clock
+        while True:
+            with clock.changed:
+                if self.closed:
+                    return
+                remaining = self.remaining_time()
+                if remaining is None or remaining > 0:
+                    clock.changed.wait(remaining)
+                    continue
+            self.end_timeline()
@@ -0,0 +1,95 @@
+import csv
+import math
+import struct
+
+from airtest.core.android.touch_methods.base_touch import DownEvent, UpEvent
+
+from driver.device import CONST, DeviceSession
+from driver.fanout import FanoutSession, VirtualClock
+
+TRACE_DOWN = 1
+TRACE_UP = 0
+# Binary trace record: time, event (TRACE_DOWN / TRACE_UP), pointer id, x, y
+TRACE_RECORD = struct.Struct('<dBBff')
+
+
+def collect_rows(device: DeviceSession, tick_time, rows):
+    for event in device.collect_touch_events():
+        if isinstance(event, DownEvent):
+            rows.append((tick_time, TRACE_DOWN, event.contact, event.coordinates[0], event.coordinates[1]))
+        elif isinstance(event, UpEvent):
+            rows.append((tick_time, TRACE_UP, event.contact, None, None))
+
+
+def render_session(session: FanoutSession) -> dict:
+    """
+    Step a FanoutSession built on a VirtualClock with start_threads=False through the scheduling code of its threads,
+    a batch is collected from every device each SAMPLING_INTERVAL as the device timer would
+
+    :return: touch rows of (time, TRACE_DOWN / TRACE_UP, pointer id, x, y) of every device, x and y are None for TRACE_UP
+    """
+    clock = session.clock
+    interval = CONST.PianoSetting.SAMPLING_INTERVAL
+    devices = [worker.device for worker in session.workers]
+    rows = {device: [] for device in devices}
+    tick = math.floor(clock.wall_time / interval) + 1
+    while True:
+        with clock.changed:
+            waits = []
+            for worker in session.workers:
+                event, wait = worker.next_event()
+                while event is not None:
+                    worker.fire(*event)
+                    event, wait = worker.next_event()
+                waits.append(wait)
+            remaining = session.remaining_time()
+        if remaining is not None and remaining <= 0:
+            session.end_timeline()
+            continue
+        if clock.wall_time >= tick * interval:
+            for device in devices:
+                collect_rows(device, tick * interval, rows[device])
+            tick += 1
+        due = [clock.wall_time + wait for wait in waits + [remaining] if wait is not None]
+        if not any(device.down_event_to_perform or device.down_event_to_revoke for device in devices):
+            if not due:
+                return rows
+            # Nothing to send, jump straight to the tick of the next event
+            tick = max(tick, math.ceil(min(due) / interval))
+        # Always move forward, a wait rounded to the current time would otherwise never come due
+        clock.advance_to(max(min(due + [tick * interval]), math.nextafter(clock.wall_time, math.inf)))
+
+
+def render_timeline(timeline, device: DeviceSession, speed=1.0) -> list:
+    """
+    Play a timeline into a single device on a virtual clock
+
+    :return: touch rows as in render_session
+    """
+    session = FanoutSession(clock=VirtualClock(), start_threads=False)
+    session.add_device(device, 0.0)
+    session.load(timeline)
+    session.set_speed(speed)
+    session.play()
+    return render_session(session)[device]
+
+
+def write_trace_csv(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", "event", "pointer", "x", "y"])
+        writer.writerows(("%.3f" % t, "down" if kind == TRACE_DOWN else "up", pointer, "" if x is None else "%.1f" % x, "" if y is None else "%.1f" % y)
+                         for t, kind, pointer, x, y in rows)
+
+
+def write_trace_binary(rows, path):
+    with open(path, 'wb') as f:
+        f.write(b"".join(TRACE_RECORD.pack(t, kind, pointer, x if x is not None else math.nan, y if y is not None else math.nan)
+                         for t, kind, pointer, x, y in rows))
+
+
+def read_trace_binary(path) -> list:
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [(t, kind, pointer, None if math.isnan(x) else x, None if math.isnan(y) else y)
+            for t, kind, pointer, x, y in TRACE_RECORD.iter_unpack(data)]
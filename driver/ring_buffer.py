@@ -0,0 +1,60 @@
+from array import array
+
+
+class RingBuffer(object):
+    """
+    Lock-free single producer / single consumer queue of integers, preallocated in an array
+
+    Only the producer moves tail and only the consumer moves head. The producer writes the slot before publishing
+    the new tail, and each index update is a single attribute store, which the GIL makes atomic.
+    """
+
+    def __init__(self, capacity=1024, typecode='h'):
+        """
+        :param capacity: rounded up to a power of two
+        :param typecode: array typecode of the items
+        """
+        super(RingBuffer, self).__init__()
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.buffer = array(typecode, [0]) * size
+        self.mask = size - 1
+        # Next slot to read, only written by the consumer
+        self.head = 0
+        # Next slot to write, only written by the producer
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    @property
+    def capacity(self):
+        return self.mask + 1
+
+    def push(self, value) -> bool:
+        """
+        Producer side, returns False without blocking when the buffer is full
+        """
+        tail = self.tail
+        if tail - self.head > self.mask:
+            return False
+        self.buffer[tail & self.mask] = value
+        self.tail = tail + 1
+        return True
+
+    def drain(self) -> list:
+        """
+        Consumer side, take every item published so far in a single step
+        """
+        head = self.head
+        tail = self.tail
+        if head == tail:
+            return []
+        start, end = head & self.mask, tail & self.mask
+        if start < end:
+            items = self.buffer[start:end].tolist()
+        else:
+            items = self.buffer[start:].tolist() + self.buffer[:end].tolist()
+        self.head = tail
+        return items
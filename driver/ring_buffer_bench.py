@@ -0,0 +1,74 @@
+import argparse
+import sys
+import threading
+import time
+
+from driver.ring_buffer import RingBuffer
+
+if __name__ == '__main__':
+    # Stress test, e.g. python -m driver.ring_buffer_bench --rate 100000 --seconds 5
+    parser = argparse.ArgumentParser(description='Single producer / single consumer RingBuffer stress benchmark')
+    parser.add_argument('--rate', type=int, default=100000, help='Events per second pushed by the producer')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--interval', type=float, default=0.02, help='Drain interval of the consumer, the device sampling interval by default')
+    parser.add_argument('--max-latency', type=float, default=0.1, help='Latency bound in seconds checked at the end')
+    args = parser.parse_args()
+
+    total = int(args.rate * args.seconds)
+    # Room for two drain intervals of events
+    ring = RingBuffer(max(int(args.rate * args.interval * 2), 1024), 'q')
+    pushed_at = [0.0] * total
+    received = []
+    latencies = []
+    full_spins = [0]
+    done = threading.Event()
+
+    def produce():
+        start = time.perf_counter()
+        seq = 0
+        while seq < total:
+            # Push everything due by now, paced at the target rate
+            due = min(int((time.perf_counter() - start) * args.rate) + 1, total)
+            while seq < due:
+                pushed_at[seq] = time.perf_counter()
+                while not ring.push(seq):
+                    full_spins[0] += 1
+                    time.sleep(0)
+                seq += 1
+            time.sleep(0.0005)
+        done.set()
+
+    def consume():
+        while True:
+            finished = done.is_set()
+            items = ring.drain()
+            now = time.perf_counter()
+            received.extend(items)
+            latencies.extend(now - pushed_at[seq] for seq in items)
+            if finished and len(ring) == 0:
+                return
+            time.sleep(args.interval)
+
+    producer = threading.Thread(target=produce)
+    consumer = threading.Thread(target=consume)
+    start_time = time.perf_counter()
+    producer.start()
+    consumer.start()
+    producer.join()
+    consumer.join()
+    elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    lost = total - len(received)
+    in_order = received == list(range(total))
+    print("Events       %d in %.2f s (%.0f/s)" % (total, elapsed, total / elapsed))
+    print("Capacity     %d" % ring.capacity)
+    print("Lost         %d" % lost)
+    print("In order     %s" % in_order)
+    print("Full spins   %d" % full_spins[0])
+    if latencies:
+        print("Latency      p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+    if lost != 0 or not in_order or (latencies and latencies[-1] > args.max_latency):
+        print("FAILED")
+        sys.exit(1)
+    print("OK")
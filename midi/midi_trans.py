@@ -1,4 +1,11 @@
+import mmap
 import os
+import struct
+
+from profiling import COUNTERS
+
+UINT16 = struct.Struct(">H")
+UINT32 = struct.Struct(">I")
 
 
 class MidiFile:
@@ -29,9 +36,19 @@ class MidiFile:
                 0x0C: "Other text format [0x0C]"
                 }
 
-    def __init__(self, midi_file, verbose=False, debug=False):
+    def __init__(self, midi_file, verbose=False, debug=False, header_only=False, tempo_map_only=False):
+        """
+        :param midi_file: path of the file, or bytes / any buffer holding its content
+        :param header_only: only read the MThd header
+        :param tempo_map_only: only read the header and the tempo changes, notes are left as the tempo map
+        """
         self.verbose = verbose
         self.debug = debug
+        self.header_only = header_only
+        self.tempo_map_only = tempo_map_only
+        self.full_parse = not (header_only or tempo_map_only)
+        # Parse records are only built when they are shown
+        self.logging = verbose or debug
 
         self.bytes = -1
         self.header_length = -1
@@ -55,21 +72,39 @@ class MidiFile:
         self.start_counter = [0] * len(MidiFile.start_sequence)
 
         self.running_status_set = False
+        self.track_index = -1
 
         self.events = []
         self.notes = []
         self.success = False
+        # Bytes actually read, set by stop before it jumps to the end
+        self.scanned = None
 
-        print("Processing", midi_file)
+        if self.full_parse:
+            print("Processing", midi_file if isinstance(midi_file, (str, os.PathLike)) else "<buffer>")
+        mapped = None
         try:
-            with open(self.midi_file, "rb") as f:
-                self.bytes = bytearray(f.read())
+            if isinstance(midi_file, (str, os.PathLike)):
+                with open(self.midi_file, "rb") as f:
+                    # Map the file instead of reading a copy of it, empty files cannot be mapped
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else None
+                self.bytes = memoryview(mapped) if mapped is not None else memoryview(b"")
+            else:
+                self.bytes = memoryview(midi_file).cast("B")
             self.readEvents()
-            print(self.key_press_count, "notes processed")
+            COUNTERS.add("files_parsed")
+            if self.scanned is None:
+                self.scanned = min(self.itr, len(self.bytes))
+            COUNTERS.add("bytes_scanned", self.scanned)
+            if self.full_parse:
+                print(self.key_press_count, "notes processed")
             self.clean_notes()
             self.success = True
         finally:
-            pass
+            if isinstance(self.bytes, memoryview):
+                self.bytes.release()
+            if mapped is not None:
+                mapped.close()
 
     def checkStartSequence(self):
         for i in range(len(self.start_sequence)):
@@ -80,6 +115,11 @@ class MidiFile:
     def skip(self, i):
         self.itr += i
 
+    def stop(self):
+        # Jump to the end of the input, ending readEvents
+        self.scanned = self.itr
+        self.itr = len(self.bytes)
+
     def readLength(self):
         cont_flag = True
         length = 0
@@ -93,6 +133,11 @@ class MidiFile:
         return length
 
     def readMTrk(self):
+        self.track_index += 1
+        if self.tempo_map_only and self.format == 1 and self.track_index > 0:
+            # Tempo changes of format 1 files are all in the first track
+            self.stop()
+            return
         length = self.getInt(4)
         self.log("MTrk len", length)
         self.readMidiTrackEvent(length)
@@ -106,13 +151,12 @@ class MidiFile:
         self.division_type = (div & 0x8000) >> 16
         self.division = div & 0x7FFF
         self.log("Format %d\nTracks %d\nDivisionType %d\nDivision %d" % (self.format, self.tracks, self.division_type, self.division))
+        if self.header_only:
+            self.stop()
 
     def readText(self, length):
-        s = ""
-        start = self.itr
-        while self.itr < length + start:
-            s += chr(self.bytes[self.itr])
-            self.itr += 1
+        s = str(self.bytes[self.itr:self.itr + length], "latin-1")
+        self.itr += length
         return s
 
     def readMidiMetaEvent(self, delta_t):
@@ -131,13 +175,13 @@ class MidiFile:
             self.log("END TRACK")
             self.itr += 2
             return False
-        elif midi_type in [0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A, 0x0C]:
+        elif midi_type in [0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A, 0x0C] and self.logging:
             self.log("\t", self.readText(length))
         elif midi_type == 0x51:
             tempo = round(60000000 / self.getInt(3))
             self.tempo = tempo
 
-            self.notes.append([(self.delta_time / self.division), "tempo=" + str(tempo)])
+            self.notes.append([(self.delta_time / self.division), "tempo=" + str(tempo), self.track_index])
             self.log("\tNew tempo is", str(tempo))
         else:
             self.itr += length
@@ -148,7 +192,9 @@ class MidiFile:
         self.delta_time = 0
         start = self.itr
         continue_flag = True
+        events = 0
         while length > self.itr - start and continue_flag:
+            events += 1
             delta_t = self.readLength()
             self.delta_time += delta_t
 
@@ -163,6 +209,7 @@ class MidiFile:
                 self.readVoiceEvent(delta_t)
         self.log("End of MTrk event, jumping from", self.itr, "to", start + length)
         self.itr = start + length
+        COUNTERS.add("events_parsed", events)
 
     def readVoiceEvent(self, delta_t):
         if self.bytes[self.itr] < 0x80 and self.running_status_set:
@@ -183,18 +230,23 @@ class MidiFile:
             self.itr += 1
             velocity = self.bytes[self.itr]
             self.itr += 1
+            if not self.full_parse:
+                # Note data is skipped when only reading the tempo map
+                return
 
             # single char
             piano_key = str(key - 21)
 
             if velocity == 0:
                 # Spec defines velocity == 0 as an alternate notation for key release
-                self.log(self.delta_time / self.division, "~" + piano_key)
-                self.notes.append([(self.delta_time / self.division), "~" + piano_key])
+                if self.logging:
+                    self.log(self.delta_time / self.division, "~" + piano_key)
+                self.notes.append([(self.delta_time / self.division), "~" + piano_key, self.track_index])
             else:
                 # Real keypress
-                self.log(self.delta_time / self.division, piano_key)
-                self.notes.append([(self.delta_time / self.division), piano_key])
+                if self.logging:
+                    self.log(self.delta_time / self.division, piano_key)
+                self.notes.append([(self.delta_time / self.division), piano_key, self.track_index])
                 self.key_press_count += 1
 
         elif midi_type >> 4 == 0x8:
@@ -203,11 +255,14 @@ class MidiFile:
             self.itr += 1
             # velocity = self.bytes[self.itr]
             self.itr += 1
+            if not self.full_parse:
+                return
 
             piano_key = str(key - 21)  # Convert from midi to 0-87 scale
 
-            self.log(self.delta_time / self.division, "~" + piano_key)
-            self.notes.append([(self.delta_time / self.division), "~" + piano_key])
+            if self.logging:
+                self.log(self.delta_time / self.division, "~" + piano_key)
+            self.notes.append([(self.delta_time / self.division), "~" + piano_key, self.track_index])
 
         elif not midi_type >> 4 in [0x8, 0x9, 0xA, 0xB, 0xD, 0xE]:
             self.log("VoiceEvent", hex(midi_type), hex(self.bytes[self.itr]), "DT", delta_t)
@@ -239,29 +294,29 @@ class MidiFile:
                     self.readMTrk()
 
     def log(self, *arg):
-        if self.verbose or self.debug:
-            for s in range(len(arg)):
-                try:
-                    print(str(arg[s]), end=" ")
-                    self.midi_record_list.append(str(arg[s]) + " ")
-                except:
-                    print("[?]", end=" ")
-                    self.midi_record_list.append("[?] ")
-            print()
-            if self.debug: input()
-            self.midi_record_list.append("\n")
-        else:
-            for s in range(len(arg)):
-                try:
-                    self.midi_record_list.append(str(arg[s]) + " ")
-                except:
-                    self.midi_record_list.append("[?] ")
-            self.midi_record_list.append("\n")
+        if not self.logging:
+            return
+        for s in range(len(arg)):
+            try:
+                print(str(arg[s]), end=" ")
+                self.midi_record_list.append(str(arg[s]) + " ")
+            except:
+                print("[?]", end=" ")
+                self.midi_record_list.append("[?] ")
+        print()
+        if self.debug: input()
+        self.midi_record_list.append("\n")
 
     def getInt(self, i):
-        k = 0
-        for n in self.bytes[self.itr:self.itr + i]:
-            k = (k << 8) + n
+        # Decode in place, without slicing the input
+        if i == 4:
+            k = UINT32.unpack_from(self.bytes, self.itr)[0]
+        elif i == 2:
+            k = UINT16.unpack_from(self.bytes, self.itr)[0]
+        elif i == 3:
+            k = (UINT16.unpack_from(self.bytes, self.itr)[0] << 8) | self.bytes[self.itr + 2]
+        else:
+            k = int.from_bytes(self.bytes[self.itr:self.itr + i], "big")
         self.itr += i
         return k
 
@@ -299,12 +354,10 @@ class MidiFile:
         return
 
     def save_song(self, song_file):
+        from midi.midi_writer import write_script  # midi_writer imports this module
+
         print("Saving notes to", song_file)
-        with open(song_file, "w+") as f:
-            f.write("playback_speed=1.0\n")
-            for l in self.notes:
-                f.write(str(l[0]) + " " + str(l[1]) + "\n")
-        return
+        write_script(self.notes, song_file)
 
 
 def get_file_choice(directory):
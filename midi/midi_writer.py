@@ -0,0 +1,150 @@
+import argparse
+import os
+import struct
+
+from midi.midi_trans import MidiFile, get_midi_file_name
+
+DEFAULT_DIVISION = 480
+DEFAULT_VELOCITY = 64
+# Piano key 0 is MIDI note 21
+KEY_OFFSET = 21
+NOTE_ON = 0x90
+END_OF_TRACK = b"\x00\xff\x2f\x00"
+
+
+def encode_vlq(value) -> bytes:
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+
+# Pre-encoded delta times up to two VLQ bytes, which covers nearly every delta of real songs
+VLQ_TABLE = [encode_vlq(i) for i in range(0x4000)]
+
+
+def vlq(value) -> bytes:
+    return VLQ_TABLE[value] if value < 0x4000 else encode_vlq(value)
+
+
+def filter_notes(notes, transpose=0, strip_tracks=()):
+    """
+    Yield (beat, event) of notes, transposed and without the stripped tracks, dropping keys out of the MIDI range
+
+    :param notes: MidiFile.notes, [beat, "key" / "~key" / "tempo=bpm", track]
+    """
+    for note in notes:
+        if len(note) > 2 and note[2] in strip_tracks:
+            continue
+        beat, event = note[0], note[1]
+        if "tempo" in event or transpose == 0:
+            yield beat, event
+            continue
+        release = event[0] == "~"
+        key = int(event[1:] if release else event) + transpose
+        if 0 <= key + KEY_OFFSET <= 127:
+            yield beat, ("~" if release else "") + str(key)
+
+
+def encode_track(notes, division) -> bytes:
+    """
+    Encode (beat, event) pairs as a single MTrk chunk, note offs are note ons with velocity 0 so that running status covers every note
+    """
+    out = bytearray()
+    last_tick = 0
+    running_status = None
+    for beat, event in notes:
+        tick = max(round(beat * division), last_tick)
+        out += vlq(tick - last_tick)
+        last_tick = tick
+        if "tempo" in event:
+            out += b"\xff\x51\x03" + round(60000000 / float(event.split("=")[1])).to_bytes(3, "big")
+            running_status = None
+            continue
+        if running_status != NOTE_ON:
+            out.append(NOTE_ON)
+            running_status = NOTE_ON
+        if event[0] == "~":
+            out.append(int(event[1:]) + KEY_OFFSET)
+            out.append(0)
+        else:
+            out.append(int(event) + KEY_OFFSET)
+            out.append(DEFAULT_VELOCITY)
+    out += END_OF_TRACK
+    return b"MTrk" + struct.pack(">I", len(out)) + bytes(out)
+
+
+def write_smf(notes, path, division=DEFAULT_DIVISION, transpose=0, strip_tracks=()):
+    """
+    Write notes as a format 0 Standard MIDI File in a single write
+    """
+    header = b"MThd" + struct.pack(">IHHH", 6, 0, 1, division)
+    track = encode_track(filter_notes(notes, transpose, strip_tracks), division)
+    with open(path, "wb") as f:
+        f.write(header + track)
+
+
+def write_script(notes, path, transpose=0, strip_tracks=(), playback_speed=1.0):
+    """
+    Write notes in the text script format read by MusicSession, in a single write
+    """
+    lines = ["playback_speed=%s\n" % playback_speed]
+    lines.extend(str(beat) + " " + event + "\n" for beat, event in filter_notes(notes, transpose, strip_tracks))
+    with open(path, "w+") as f:
+        f.write("".join(lines))
+
+
+def read_script(path) -> (float, list):
+    """
+    Read a text script, the inverse of write_script, also used by MusicSession
+
+    :rtype: playback speed, notes of [beat, event]
+    """
+    notes = []
+    with open(path, "r") as f:
+        lines = f.read().split("\n")
+    playback_speed = float(lines[0].split("=")[1])
+    for line in lines[1:]:
+        line_split = line.split(" ")
+        if len(line_split) < 2:
+            continue
+        notes.append([float(line_split[0]), line_split[1]])
+    return playback_speed, notes
+
+
+def convert_folder(in_folder, out_folder, transpose=0, strip_tracks=(), script=False):
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    for f in sorted(os.listdir(in_folder)):
+        path = os.path.join(in_folder, f)
+        try:
+            if ".mid" in f.lower():
+                midi = MidiFile(path)
+                notes, division = midi.notes, midi.division
+            elif f.endswith(".txt"):
+                notes, division = read_script(path)[1], DEFAULT_DIVISION
+            else:
+                continue
+            if script:
+                write_script(notes, os.path.join(out_folder, get_midi_file_name(f) + ".txt"), transpose, strip_tracks)
+            else:
+                write_smf(notes, os.path.join(out_folder, get_midi_file_name(f) + ".mid"), division, transpose, strip_tracks)
+        except Exception as e:
+            # A single malformed file must not abort the rest of the batch
+            print("Error converting", f, e)
+
+
+if __name__ == "__main__":
+    # e.g. python -m midi.midi_writer songs normalized --transpose -12 --strip-tracks 2,3
+    parser = argparse.ArgumentParser(description='Normalize midi files or scripts into Standard MIDI Files or scripts')
+    parser.add_argument('in_folder', type=str, help='Folder of .mid files or .txt scripts')
+    parser.add_argument('out_folder', type=str)
+    parser.add_argument('--transpose', type=int, default=0, help='Semitones to transpose by')
+    parser.add_argument('--strip-tracks', type=str, default='', help='Comma separated indexes of tracks to drop, .mid input only')
+    parser.add_argument('--script', action='store_true', help='Write text scripts instead of Standard MIDI Files')
+
+    args = parser.parse_args()
+    stripped = tuple(int(t) for t in args.strip_tracks.split(",") if t)
+    convert_folder(args.in_folder, args.out_folder, args.transpose, stripped, args.script)
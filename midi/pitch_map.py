@@ -0,0 +1,64 @@
+import argparse
+
+import numpy as np
+
+from midi.timeline import Timeline
+
+NUM_OF_KEYS = 88
+
+
+class PitchMap(object):
+    """
+    Transposition and octave folding of a timeline into the playable key range, applied once per song instead of per note
+    """
+
+    def __init__(self, transpose=0, low=0, high=NUM_OF_KEYS - 1, fold=True):
+        """
+        :param transpose: semitones added to every key
+        :param low: lowest playable piano key, 0 is A0
+        :param high: highest playable piano key, 87 is C8
+        :param fold: move out of range keys by octaves into the range, otherwise they are dropped
+        """
+        super(PitchMap, self).__init__()
+        if not 0 <= low <= high < NUM_OF_KEYS:
+            raise ValueError("Invalid key range %d-%d" % (low, high))
+        self.transpose = transpose
+        self.low = low
+        self.high = high
+        self.fold = fold
+
+    def cache_key(self):
+        return self.transpose, self.low, self.high, self.fold
+
+    def map_keys(self, keys) -> (np.ndarray, np.ndarray):
+        """
+        :return: mapped keys and the mask of keys inside the range
+        """
+        keys = keys.astype(np.int32) + self.transpose
+        if self.fold:
+            keys = np.where(keys < self.low, keys + 12 * ((self.low - keys + 11) // 12), keys)
+            keys = np.where(keys > self.high, keys - 12 * ((keys - self.high + 11) // 12), keys)
+        return keys, (keys >= self.low) & (keys <= self.high)
+
+    def apply(self, timeline: Timeline) -> Timeline:
+        keys, valid = self.map_keys(timeline.keys)
+        times, keys, presses = timeline.times[valid], keys[valid], timeline.presses[valid]
+        # Notes folded onto the same key at the same time collide, keep the first of each
+        order = np.lexsort((presses, keys, times))
+        duplicate = (times[order][1:] == times[order][:-1]) & (keys[order][1:] == keys[order][:-1]) & (presses[order][1:] == presses[order][:-1])
+        keep = np.ones(len(times), dtype=np.bool_)
+        keep[order[1:][duplicate]] = False
+        return Timeline(times[keep], keys[keep], presses[keep], timeline.duration)
+
+
+def parse_key_range(text) -> (int, int):
+    """
+    Argparse type of a LOW-HIGH key range, bad ranges are usage errors rather than tracebacks from PitchMap
+    """
+    try:
+        low, high = (int(key) for key in text.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected LOW-HIGH, got %s" % text)
+    if not 0 <= low <= high < NUM_OF_KEYS:
+        raise argparse.ArgumentTypeError("invalid key range %s, keys are 0-%d" % (text, NUM_OF_KEYS - 1))
+    return low, high
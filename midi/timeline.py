@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class Timeline(object):
+    """
+    Note events of a song at absolute times, in seconds at playback speed 1.0
+    """
+
+    def __init__(self, times, keys, presses, duration):
+        super(Timeline, self).__init__()
+        self.times = np.asarray(times, dtype=np.float64)
+        self.keys = np.asarray(keys, dtype=np.int16)
+        self.presses = np.asarray(presses, dtype=np.bool_)
+        self.duration = float(duration)
+        # Plain python copies, playback threads index these once per event
+        self.time_list = self.times.tolist()
+        self.events = list(zip(self.time_list, self.keys.tolist(), self.presses.tolist()))
+
+    def __len__(self):
+        return len(self.events)
+
+    @staticmethod
+    def from_notes(notes):
+        """
+        Build a timeline from notes as produced by MusicSession.parse_info
+
+        :param notes: list of [delay to the next note, "key" or "~key"]
+        """
+        times = []
+        keys = []
+        presses = []
+        now = 0.0
+        for delay, note in notes:
+            if "tempo" not in note:
+                times.append(now)
+                if note[0] == "~":
+                    keys.append(int(note[1:]))
+                    presses.append(False)
+                else:
+                    keys.append(int(note))
+                    presses.append(True)
+            now += max(delay, 0)
+        return Timeline(times, keys, presses, now)
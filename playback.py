@@ -1,13 +1,22 @@
 import argparse
+import atexit
+import bisect
 import configparser
 import os
-import threading
 import time
 
 import keyboard
 
 from driver.device import DeviceSession
+from driver.fanout import FanoutSession
+from driver.render import render_timeline, write_trace_binary, write_trace_csv
 from midi.midi_trans import get_file_choice, get_midi_file_name, process_midi
+from midi.midi_writer import read_script
+from midi.pitch_map import PitchMap, parse_key_range
+from midi.timeline import Timeline
+from playback_server import PlaybackServer
+from playlist import Playlist, PlaylistSession
+from profiling import COUNTERS, Profiler
 
 key_p = 'p'
 key_r = 'r'
@@ -15,59 +24,50 @@ key_a = 'a'
 key_z = 'z'
 key_dot = '.'
 key_comma = ','
+key_s = 's'
 
 
-class MusicSession(object):
-    is_playing = False
-    songs_folder = "songs"
-    scripts_folder = "scripts"
-    current_session = None
-    device_session: DeviceSession = None
+class DryRunDevice(object):
 
     @staticmethod
-    def press_callback(note):
+    def play_note(note):
         print("Pressed note", note)
 
     @staticmethod
-    def release_callback(note):
+    def release_note(note):
         print("Released note", note)
 
+
+class MusicSession(object):
+    songs_folder = "songs"
+    scripts_folder = "scripts"
+    current_session = None
+    player: FanoutSession = None
+    playlist_session: PlaylistSession = None
+    pitch_map = PitchMap()
+
     def __init__(self, script_file):
         super(MusicSession, self).__init__()
         self.music = None
         self.script_file = script_file
-        self.stored_index = 0
         self.playback_speed = 1.0
         self.playback_speed_multiplier = 1.0
         self.playback_speed_temp = 1.0
         self.process_file()
 
         self.parse_info()
+        self.raw_timeline = Timeline.from_notes(self.music[2])
+        # Timelines mapped into the playable range, by PitchMap.cache_key
+        self.mapped_timelines = {}
+        self.timeline = self.apply_pitch_map(self.pitch_map)
 
     def process_file(self) -> (float, int, list):
-        with open(os.path.join(self.scripts_folder, self.script_file), 'r') as f:
-            lines = f.read().split("\n")
-            time_offset_valid = False
-            time_offset = 0
-            self.playback_speed = float(lines[0].split("=")[1])
-            print("Playback speed is set to %.2f" % self.playback_speed)
-            tempo = 60 / float(lines[1].split("=")[1])
-
-            processed_notes = []
-
-            for line in lines[1:]:
-                line_split = line.split(" ")
-                if len(line_split) < 2:
-                    # print("INVALID LINE")
-                    continue
-
-                wait_to_press = float(line_split[0])
-                notes = line_split[1]
-                processed_notes.append([wait_to_press, notes])
-                if not time_offset_valid:
-                    time_offset = wait_to_press
-                    print("Start time offset =", time_offset)
-                    time_offset_valid = True
+        self.playback_speed, processed_notes = read_script(os.path.join(self.scripts_folder, self.script_file))
+        print("Playback speed is set to %.2f" % self.playback_speed)
+        # The script starts with the initial tempo
+        tempo = 60 / float(processed_notes[0][1].split("=")[1])
+        time_offset = processed_notes[0][0]
+        print("Start time offset =", time_offset)
         self.music = [tempo, time_offset, processed_notes]
         return self.music
 
@@ -97,13 +97,21 @@ class MusicSession(object):
         self.music[2] = notes
         return notes
 
+    def apply_pitch_map(self, pitch_map: PitchMap) -> Timeline:
+        key = pitch_map.cache_key()
+        if key not in self.mapped_timelines:
+            self.mapped_timelines[key] = pitch_map.apply(self.raw_timeline)
+        self.timeline = self.mapped_timelines[key]
+        return self.timeline
+
     def adjust_playback_speed_multiplier(self, multiplier):
         if multiplier <= 0.0:
             print("Invalid multiplier")
             return
         self.playback_speed_multiplier = multiplier
         self.playback_speed_temp = self.playback_speed * self.playback_speed_multiplier
-        print("Playback speed is now %.2f" % self.playback_speed)
+        self.player.set_speed(self.playback_speed_temp)
+        print("Playback speed is now %.2f" % self.playback_speed_temp)
 
     def slow_down(self):
         self.adjust_playback_speed_multiplier(self.playback_speed_multiplier - 0.1)
@@ -111,59 +119,36 @@ class MusicSession(object):
     def speed_up(self):
         self.adjust_playback_speed_multiplier(self.playback_speed_multiplier + 0.1)
 
-    def play_next_note(self):
-        try:
-            notes: list = self.music[2]
-            if MusicSession.is_playing and self.stored_index < len(self.music[2]):
-                note_info = notes[self.stored_index]
-                delay = floor_to_zero(note_info[0])
-                if note_info[1][0] == "~":
-                    # release notes
-                    # parse note_info[1][1:] as int
-                    self.release_callback(int(note_info[1][1:]))
-                else:
-                    # press notes
-                    self.press_callback(int(note_info[1]))
-
-                # if "~" not in note_info[1]:
-                #     print("%10.2f %15s" % (delay, note_info[1]))
-                # print("%10.2f %15s" % (delay/playback_speed,note_info[1]))
-                self.stored_index += 1
-                if delay == 0:
-                    self.play_next_note()
-                else:
-                    threading.Timer(delay / self.playback_speed_temp, self.play_next_note).start()
-            elif self.stored_index >= len(self.music[2]):
-                self.current_session = None
-                on_key_z_press(None)
-        except Exception as e:
-            print("Error in play_next_note", e)
-            on_key_z_press(None)
+    def load(self):
+        self.player.load(self.timeline)
+        self.player.set_speed(self.playback_speed_temp)
+
+    def current_index(self):
+        return bisect.bisect_left(self.timeline.time_list, self.player.position())
 
     def rewind(self):
-        if self.stored_index - 10 < 0:
-            self.stored_index = 0
-        else:
-            self.stored_index -= 10
-        print("Rewound to %.2f" % self.stored_index)
+        index = max(self.current_index() - 10, 0)
+        if index < len(self.timeline):
+            self.player.seek(self.timeline.time_list[index])
+        print("Rewound to %d" % index)
 
     def skip(self):
-        if self.stored_index + 10 > len(self.music[2]):
-            self.current_session = None
-            on_key_z_press(None)
-        else:
-            self.stored_index += 10
-        print("Skipped to %.2f" % self.stored_index)
+        index = self.current_index() + 10
+        if index >= len(self.timeline):
+            # Seeking to the end moves on to the next song
+            self.player.seek(self.timeline.duration)
+            print("Skipped to the end")
+            return
+        self.player.seek(self.timeline.time_list[index])
+        print("Skipped to %d" % index)
 
 
 def on_key_p_press(event):
     if MusicSession.current_session is None:
         print("No song selected")
         return True
-    MusicSession.is_playing = not MusicSession.is_playing
-    if MusicSession.is_playing:
+    if MusicSession.player.toggle():
         print("Playing...")
-        MusicSession.current_session.play_next_note()
     else:
         print("Stopping...")
     return True
@@ -190,20 +175,37 @@ def on_key_a_press(event):
     return True
 
 
+def load_music_session(target) -> MusicSession:
+    # if target file exists in scripts folder, use that
+    if not os.path.exists(os.path.join(MusicSession.scripts_folder, get_midi_file_name(target) + ".txt")):
+        print("Script file not found, generating...")
+        process_midi(os.path.join(MusicSession.songs_folder, target), MusicSession.scripts_folder)
+    return MusicSession(get_midi_file_name(target) + ".txt")
+
+
 def on_key_z_press(event):
-    if MusicSession.is_playing:
+    if MusicSession.player.is_playing:
         on_key_p_press(None)
     target = get_file_choice(MusicSession.songs_folder)
-    # if target file exists in scripts folder, use that
     try:
-        if not os.path.exists(os.path.join(MusicSession.scripts_folder, get_midi_file_name(target) + ".txt")):
-            print("Script file not found, generating...")
-            process_midi(os.path.join(MusicSession.songs_folder, target), MusicSession.scripts_folder)
+        MusicSession.playlist_session.load(target)
     except Exception as e:
         print("Error during processing MIDI", e)
-        return True
+    return True
+
+
+def on_song_changed(name, session):
+    print("Now playing", name)
+    MusicSession.current_session = session
+
+
+def on_song_finished():
+    MusicSession.current_session = None
+    on_key_z_press(None)
+
 
-    MusicSession.current_session = MusicSession(get_midi_file_name(target) + ".txt")
+def on_key_s_press(event):
+    COUNTERS.dump()
     return True
 
 
@@ -221,8 +223,24 @@ def on_key_dot_press(event):
     return True
 
 
-def floor_to_zero(i):
-    return i if i > 0 else 0
+def render_songs(out_folder, trace_format):
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    songs = sorted(f for f in os.listdir(MusicSession.songs_folder) if ".mid" in f.lower())
+    for song in songs:
+        try:
+            session = load_music_session(song)
+        except Exception as e:
+            print("Error during processing MIDI", e)
+            continue
+        start = time.perf_counter()
+        rows = render_timeline(session.timeline, DeviceSession(start_timer=False, verbose=False), session.playback_speed_temp)
+        trace_file = os.path.join(out_folder, get_midi_file_name(song) + "." + trace_format)
+        if trace_format == "csv":
+            write_trace_csv(rows, trace_file)
+        else:
+            write_trace_binary(rows, trace_file)
+        print("Rendered %s: %.1f s of music, %d touch events in %.3f s" % (trace_file, session.timeline.duration / session.playback_speed_temp, len(rows), time.perf_counter() - start))
 
 
 def print_help():
@@ -233,6 +251,7 @@ def print_help():
     print("Press R to rewind")
     print("Press A to advance")
     print("Press Z to select a song")
+    print("Press S to show counters")
 
 
 if __name__ == "__main__":
@@ -240,21 +259,58 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Song playback options')
     parser.add_argument('--dry-run', action='store_true', help='Run without sending commands to the device')
     parser.add_argument('-f', '--songs-folder', type=str, help="Path to the folder containing the songs, defaults to './songs'")
+    parser.add_argument('--serve', type=int, metavar='PORT', help='Run headless, controlled through a JSON API on localhost:PORT instead of hotkeys')
+    parser.add_argument('--playlist', action='store_true', help='Play every song of the songs folder in order without gaps')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of upcoming songs parsed in the background, defaults to 2')
+    parser.add_argument('--transpose', type=int, default=0, help='Semitones to transpose every song by')
+    parser.add_argument('--key-range', type=parse_key_range, metavar='LOW-HIGH', help='Playable piano keys (0 is A0, 87 is C8), notes outside are folded in by octaves, defaults to 0-87')
+    parser.add_argument('--profile', choices=['cpu', 'memory'], help='Profile parsing and playback with cProfile (cpu) or tracemalloc (memory), reported at exit')
+    parser.add_argument('--profile-output', type=str, help='File to save the cpu profile to, for pstats or snakeviz')
+    parser.add_argument('--render', type=str, metavar='OUT_FOLDER', help='Render the touch trace of every song to OUT_FOLDER on a virtual clock and exit')
+    parser.add_argument('--render-format', choices=['csv', 'bin'], default='csv', help='Touch trace format of --render, defaults to csv')
 
     args = parser.parse_args()
     dry_run = args.dry_run
     songs_folder = args.songs_folder
+    serve_port = args.serve
+    play_all = args.playlist
 
     if songs_folder is not None:
         MusicSession.songs_folder = songs_folder
 
-    if not dry_run:
-        # Read ini file
+    # Registered first so that the counters are printed after the profile
+    atexit.register(COUNTERS.dump)
+    if args.profile is not None:
+        profiler = Profiler(args.profile, args.profile_output)
+        profiler.start()
+        atexit.register(profiler.report)
+
+    key_range = args.key_range if args.key_range is not None else (0, 87)
+    MusicSession.pitch_map = PitchMap(args.transpose, key_range[0], key_range[1])
+
+    if args.render is not None:
+        render_songs(args.render, args.render_format)
+        raise SystemExit(0)
+
+    MusicSession.player = FanoutSession()
+    MusicSession.playlist_session = PlaylistSession(MusicSession.player, Playlist(load_music_session, prefetch=args.prefetch), on_song_changed, on_song_finished)
+    if dry_run:
+        MusicSession.player.add_device(DryRunDevice(), 0.0)
+    else:
+        # Read ini file, every section starting with "Device" is a device to play on
         config = configparser.ConfigParser()
         config.read('driver/device.ini')
-        device_address = config['Device']['Address']
-        MusicSession.device_session = DeviceSession(device_address)
-        MusicSession.press_callback = MusicSession.device_session.play_note
+        for section in config.sections():
+            if not section.startswith('Device'):
+                continue
+            latency = config[section].getfloat('LatencyOffset')
+            MusicSession.player.add_device(DeviceSession(config[section]['Address']), latency / 1000 if latency is not None else None)
+
+    if serve_port is not None:
+        MusicSession.playlist_session.on_finished = None
+        server = PlaybackServer(('127.0.0.1', serve_port), MusicSession.playlist_session, MusicSession.songs_folder)
+        print("Serving playback API on http://127.0.0.1:%d" % serve_port)
+        server.serve_forever()
 
     keyboard.on_press_key(key_p, on_key_p_press)
     keyboard.on_press_key(key_r, on_key_r_press)
@@ -262,9 +318,16 @@ if __name__ == "__main__":
     keyboard.on_press_key(key_z, on_key_z_press)
     keyboard.on_press_key(key_comma, on_key_comma_press)
     keyboard.on_press_key(key_dot, on_key_dot_press)
+    keyboard.on_press_key(key_s, on_key_s_press)
 
     print_help()
-    on_key_z_press(None)
+    if play_all:
+        songs = sorted(f for f in os.listdir(MusicSession.songs_folder) if ".mid" in f.lower())
+        for song in songs[1:]:
+            MusicSession.playlist_session.playlist.add(song)
+        MusicSession.playlist_session.load(songs[0])
+    else:
+        on_key_z_press(None)
     on_key_p_press(None)
 
     time.sleep(100000)
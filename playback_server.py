@@ -0,0 +1,146 @@
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from playlist import PlaylistSession
+from profiling import COUNTERS
+
+
+class PlaybackRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON control API, bodies of POST requests are JSON objects
+
+    GET  /status                        current song, position, speed and queue
+    GET  /songs                         midi files in the songs folder
+    GET  /stats                         hot path counters
+    POST /load   {"song": "a.mid"}      load a song, paused at the start
+    POST /queue  {"song": "a.mid"}      append a song to the queue and preload it
+    POST /play
+    POST /pause
+    POST /next                          skip to the next song in the queue
+    POST /seek   {"position": 12.5}     seek to a position in seconds
+    POST /speed  {"speed": 1.2}         set the playback speed multiplier
+    """
+
+    def do_GET(self):
+        routes = {"/status": self.server.status, "/songs": self.server.list_songs, "/stats": COUNTERS.snapshot}
+        self.dispatch(routes, None)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}") if length > 0 else {}
+        except ValueError:
+            self.send_json(400, {"error": "Invalid JSON body"})
+            return
+        if not isinstance(body, dict):
+            self.send_json(400, {"error": "JSON body must be an object"})
+            return
+        routes = {
+            "/load": lambda: self.server.load(body["song"]),
+            "/queue": lambda: self.server.enqueue(body["song"]),
+            "/play": self.server.play,
+            "/pause": self.server.pause,
+            "/next": self.server.next_song,
+            "/seek": lambda: self.server.seek(float(body["position"])),
+            "/speed": lambda: self.server.set_speed(float(body["speed"])),
+        }
+        self.dispatch(routes, body)
+
+    def dispatch(self, routes, body):
+        route = routes.get(urlparse(self.path).path)
+        if route is None:
+            self.send_json(404, {"error": "Unknown endpoint " + self.path})
+            return
+        try:
+            self.send_json(200, route())
+        except KeyError as e:
+            self.send_json(400, {"error": "Missing field %s" % e})
+        except (ValueError, TypeError, OSError) as e:
+            self.send_json(400, {"error": str(e)})
+        except RuntimeError as e:
+            self.send_json(409, {"error": str(e)})
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class PlaybackServer(ThreadingHTTPServer):
+    """
+    Headless playback daemon, parsed songs stay warm in the playlist cache and queued songs are prepared in the background
+    """
+
+    def __init__(self, address, session: PlaylistSession, songs_folder):
+        super(PlaybackServer, self).__init__(address, PlaybackRequestHandler)
+        self.session = session
+        self.player = session.player
+        self.playlist = session.playlist
+        self.songs_folder = songs_folder
+
+    def require_name(self, name):
+        if not isinstance(name, str):
+            raise TypeError("Song must be a file name")
+        # Only files of the songs folder, names such as ../x.mid would be read and converted from anywhere
+        if name not in self.list_songs():
+            raise ValueError("Unknown song %s" % name)
+        return name
+
+    def require_song(self):
+        if self.session.current is None:
+            raise RuntimeError("No song loaded")
+
+    def list_songs(self):
+        return sorted(f for f in os.listdir(self.songs_folder) if ".mid" in f.lower())
+
+    def status(self):
+        current = self.session.current
+        return {
+            "song": self.session.current_name,
+            "playing": self.player.is_playing,
+            "position": self.player.position() if current is not None else 0.0,
+            "duration": current.timeline.duration if current is not None else 0.0,
+            "speed": current.playback_speed_multiplier if current is not None else 1.0,
+            "queue": list(self.playlist.upcoming),
+            "loaded": list(self.playlist.prepared),
+        }
+
+    def load(self, name):
+        self.session.load(self.require_name(name))
+        return self.status()
+
+    def enqueue(self, name):
+        self.playlist.add(self.require_name(name))
+        self.session.queue_next()
+        return self.status()
+
+    def play(self):
+        self.require_song()
+        self.player.play()
+        return self.status()
+
+    def pause(self):
+        self.player.pause()
+        return self.status()
+
+    def next_song(self):
+        if not self.session.next_song():
+            raise RuntimeError("Queue is empty")
+        return self.status()
+
+    def seek(self, position):
+        self.require_song()
+        self.player.seek(position)
+        return self.status()
+
+    def set_speed(self, speed):
+        self.require_song()
+        if speed <= 0.0:
+            raise ValueError("Speed must be positive")
+        self.session.current.adjust_playback_speed_multiplier(speed)
+        return self.status()
@@ -0,0 +1,211 @@
+import threading
+from collections import OrderedDict, deque
+
+
+class Playlist(object):
+    """
+    Songs to play in order, a background worker prepares the next few and keeps prepared songs in a bounded LRU
+    """
+
+    def __init__(self, song_loader, prefetch=2, cache_size=8):
+        """
+        :param song_loader: callable returning a prepared song (MusicSession) for a song name
+        :param prefetch: number of upcoming songs prepared ahead
+        :param cache_size: maximum number of prepared songs kept in memory
+        """
+        super(Playlist, self).__init__()
+        self.song_loader = song_loader
+        self.prefetch = prefetch
+        self.cache_size = max(cache_size, prefetch + 1)
+        self.upcoming = deque()
+        self.prepared = OrderedDict()
+        self.failed = set()
+        # Names being parsed by the worker or by get, each song is parsed by one thread at a time
+        self.loading = set()
+        self.on_prepared = None
+        self.changed = threading.Condition()
+        self.closed = False
+        self.worker = threading.Thread(target=self.prepare_loop, daemon=True)
+        self.worker.start()
+
+    def add(self, name):
+        with self.changed:
+            self.failed.discard(name)
+            self.upcoming.append(name)
+            self.changed.notify_all()
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def store(self, name, song):
+        # Caller holds the lock
+        self.prepared[name] = song
+        self.prepared.move_to_end(name)
+        keep = set(self.window())
+        for old in list(self.prepared):
+            if len(self.prepared) <= self.cache_size:
+                break
+            if old not in keep and old != name:
+                del self.prepared[old]
+
+    def get(self, name):
+        """
+        Return a prepared song, preparing it in the calling thread if needed
+        """
+        with self.changed:
+            while name in self.loading:
+                self.changed.wait()
+            if name in self.prepared:
+                self.prepared.move_to_end(name)
+                return self.prepared[name]
+            self.loading.add(name)
+        song = None
+        try:
+            song = self.song_loader(name)
+        finally:
+            with self.changed:
+                self.loading.discard(name)
+                if song is not None:
+                    self.store(name, song)
+                self.changed.notify_all()
+        return song
+
+    def peek_prepared(self):
+        """
+        Name and song of the next song if it is already prepared, never blocks on parsing
+        """
+        with self.changed:
+            while self.upcoming and self.upcoming[0] in self.failed:
+                print("Skipping", self.upcoming.popleft())
+            if self.upcoming and self.upcoming[0] in self.prepared:
+                name = self.upcoming[0]
+                return name, self.prepared[name]
+        return None
+
+    def pop_next(self):
+        with self.changed:
+            name = self.upcoming.popleft() if self.upcoming else None
+            self.changed.notify_all()
+        return name
+
+    def window(self) -> list:
+        # Caller holds the lock. Songs that failed to parse do not take a prefetch slot
+        return [name for name in self.upcoming if name not in self.failed][:self.prefetch]
+
+    def next_to_prepare(self):
+        # Caller holds the lock
+        for name in self.window():
+            if name not in self.prepared and name not in self.loading:
+                return name
+        return None
+
+    def prepare_loop(self):
+        while True:
+            with self.changed:
+                name = self.next_to_prepare()
+                while not self.closed and name is None:
+                    self.changed.wait()
+                    name = self.next_to_prepare()
+                if self.closed:
+                    return
+                self.loading.add(name)
+            try:
+                song = self.song_loader(name)
+            except Exception as e:
+                print("Error preparing", name, e)
+                song = None
+            with self.changed:
+                self.loading.discard(name)
+                if song is None:
+                    self.failed.add(name)
+                else:
+                    self.store(name, song)
+                self.changed.notify_all()
+            if song is not None and self.on_prepared is not None:
+                self.on_prepared()
+
+
+class PlaylistSession(object):
+    """
+    Plays a Playlist on a FanoutSession, the next prepared song is queued on the player so transitions have no gap
+    """
+
+    def __init__(self, player, playlist: Playlist, on_song_changed=None, on_finished=None):
+        super(PlaylistSession, self).__init__()
+        self.player = player
+        self.player.on_advanced = self.on_advanced
+        self.player.on_finished = self.on_player_finished
+        self.playlist = playlist
+        self.playlist.on_prepared = self.queue_next
+        self.on_song_changed = on_song_changed
+        self.on_finished = on_finished
+        self.lock = threading.RLock()
+        self.current = None
+        self.current_name = None
+        # Name and song already queued on the player, and the player segment they were queued as
+        self.queued = None
+        self.queued_segment = None
+
+    def set_current(self, name, song):
+        self.current, self.current_name = song, name
+        if self.on_song_changed is not None:
+            self.on_song_changed(name, song)
+
+    def load(self, name):
+        song = self.playlist.get(name)
+        with self.lock:
+            self.queued = None
+            self.set_current(name, song)
+            song.load()
+            self.queue_next()
+        return song
+
+    def queue_next(self):
+        with self.lock:
+            if self.current is None or self.queued is not None:
+                return
+            ready = self.playlist.peek_prepared()
+            if ready is not None:
+                self.queued = ready
+                self.queued_segment = self.player.append(ready[1].timeline)
+
+    def next_song(self):
+        name = self.playlist.pop_next()
+        if name is None:
+            return False
+        self.load(name)
+        self.player.play()
+        return True
+
+    def on_advanced(self, timeline):
+        # Runs on the player thread at the transition, only touches songs already in memory
+        with self.lock:
+            segments = self.player.segments
+            if self.queued is None or self.queued[1].timeline is not timeline or not segments or segments[0] is not self.queued_segment:
+                # A load or next_song replaced the queued song before the transition was handled
+                return
+            name, song = self.queued
+            self.queued = None
+            with self.playlist.changed:
+                if self.playlist.upcoming and self.playlist.upcoming[0] == name:
+                    self.playlist.upcoming.popleft()
+            self.set_current(name, song)
+            self.player.set_speed(song.playback_speed_temp)
+            self.queue_next()
+
+    def on_player_finished(self):
+        # Parsing a song that was not prepared in time, or prompting for the next one, must not block the player thread
+        threading.Thread(target=self.finish, daemon=True).start()
+
+    def finish(self):
+        while self.playlist.upcoming:
+            try:
+                if self.next_song():
+                    return
+            except Exception as e:
+                # Move on to the song after the one that failed
+                print("Error loading the next song", e)
+        if self.on_finished is not None:
+            self.on_finished()
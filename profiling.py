@@ -0,0 +1,115 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import tracemalloc
+
+
+class Counters(object):
+    """
+    Always-on hot path counters, cheap enough to be updated once per batch or per parsed track
+    """
+
+    def __init__(self):
+        super(Counters, self).__init__()
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + n
+
+    def record_max(self, name, value):
+        with self.lock:
+            if value > self.values.get(name, 0):
+                self.values[name] = value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def dump(self):
+        print()
+        print("Counters")
+        print("-" * 20)
+        for name, value in sorted(self.snapshot().items()):
+            print("%-20s %d" % (name, value))
+
+
+COUNTERS = Counters()
+
+
+class Profiler(object):
+    """
+    cProfile of every thread ("cpu") or tracemalloc allocation sites ("memory") from start to report
+    """
+
+    def __init__(self, mode, output=None, limit=25):
+        """
+        :param output: file the combined cProfile stats are saved to, for snakeviz or pstats
+        """
+        super(Profiler, self).__init__()
+        self.mode = mode
+        self.output = output
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.main_profile = None
+        # (thread, profile) of every profiled thread still running
+        self.profiles = []
+        # Combined stats of the threads that have exited
+        self.finished = None
+
+    def start(self):
+        if self.mode == "cpu":
+            # cProfile only sees the thread it is enabled in, so every new thread gets its own
+            threading.setprofile(self.profile_thread)
+            self.main_profile = cProfile.Profile()
+            self.main_profile.enable()
+        else:
+            tracemalloc.start(10)
+
+    def profile_thread(self, frame, event, arg):
+        # First profiler call in a new thread, replace this hook by a profiler of the thread
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.merge_finished()
+            self.profiles.append((threading.current_thread(), profile))
+        profile.enable()
+
+    def merge_finished(self):
+        # Caller holds the lock. Short lived threads such as the device timers would otherwise keep a profile each
+        for thread, profile in list(self.profiles):
+            if thread.is_alive():
+                continue
+            self.profiles.remove((thread, profile))
+            if self.finished is None:
+                self.finished = pstats.Stats(profile)
+            else:
+                self.finished.add(profile)
+
+    def report(self):
+        print()
+        print("Profile (%s)" % self.mode)
+        print("-" * 20)
+        if self.mode == "cpu":
+            threading.setprofile(None)
+            self.main_profile.disable()
+            out = io.StringIO()
+            with self.lock:
+                self.merge_finished()
+                stats = pstats.Stats(self.main_profile, *[profile for _, profile in self.profiles], stream=out)
+                if self.finished is not None:
+                    stats.add(self.finished)
+            stats.sort_stats("cumulative").print_stats(self.limit)
+            print(out.getvalue())
+            if self.output is not None:
+                stats.dump_stats(self.output)
+                print("Saved profile to", self.output)
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            print("Current %.1f KiB, peak %.1f KiB" % (current / 1024, peak / 1024))
+            for stat in snapshot.statistics("lineno")[:self.limit]:
+                print(stat)